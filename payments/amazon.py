@@ -24,9 +24,12 @@ from hashlib import sha256
 import base64
 import hmac
 import xml.parsers.expat
+from payments.money import Money, MoneyError
 
 class AmazonError(Exception):
     def __init__(self, value):
+        # set args so the error can be pickled (i.e. by PaymentWorkerPool)
+        Exception.__init__(self, value)
         self.value = value
     def __str__(self):
         return repr(self.value)
@@ -63,19 +66,21 @@ class FlexiblePaymentsService(object):
 
     """
     def __init__(self, api_username=None, api_password=None, return_url='', \
-        api_version='2010-08-28', debug=False):
+        api_version='2010-08-28', debug=False, hedger=None):
         """
 
         :keyword api_user: PayPal API username
         :keyword api_password: PayPal API password
         :keyword return_url: Return url 
         :keyword debug: Sets the url to the PayPal sandbox url (default False)
+        :keyword hedger: Optional Hedger used for read-only lookups (transaction status)
 
         """
         if not api_username or not api_password :
             raise AmazonError("""You must specify an api_username and api_password, """)
         self.__api_username = api_username
         self.__api_password = api_password
+        self.__hedger = hedger
         self.__api_version = api_version
         self.__api_return_url = return_url
         if debug:
@@ -112,7 +117,17 @@ class FlexiblePaymentsService(object):
 
     def get_api_endpoint(self): return self.__api_base_url
 
-    def do_request(self, action=None, data={}):
+    def _format_amount(self, amount=None, currency='USD'):
+        """
+        Validates an amount and formats it for the request
+
+        """
+        try:
+            return str(Money(amount, currency))
+        except MoneyError as e:
+            raise AmazonError(e.value)
+
+    def do_request(self, action=None, data=None):
         """
         Makes a PayPal AdaptivePayments API request with the specified params
         
@@ -128,6 +143,7 @@ class FlexiblePaymentsService(object):
         headers = {
         }
         method = 'GET'
+        data = dict(data or {})
         data['Action'] = str(action)
         data['AWSAccessKeyId'] = str(self.__api_username)
         data['Version'] = str(self.__api_version)
@@ -157,14 +173,15 @@ class FlexiblePaymentsService(object):
         :keyword global_amount_limit: Maximum amount that can be charged during the 
             entire authorization period
         :keyword payment_reason: Note or description to user 
-        :keyword data: Optional extra data
+        :keyword data: Optional extra data (amounts use data['currencyCode'] if set)
         :rtype: url as string
 
         """
+        currency = data.get('currencyCode', 'USD')
         data['pipelineName'] = token_type
-        data['transactionAmount'] = str(transaction_amount)
+        data['transactionAmount'] = self._format_amount(transaction_amount, currency)
         data['amountType'] = amount_type
-        data['globalAmountLimit'] = str(global_amount_limit)
+        data['globalAmountLimit'] = self._format_amount(global_amount_limit, currency)
         data['paymentReason'] = payment_reason
         if not caller_reference:
             caller_reference = str(uuid.uuid4())
@@ -193,7 +210,10 @@ class FlexiblePaymentsService(object):
             raise AmazonError('You must specify a transaction_id')
         data = {}
         data['TransactionId'] = transaction_id
-        resp, cont = self.do_request('GetTransactionStatus', data)
+        if self.__hedger:
+            resp, cont = self.__hedger.call(self.do_request, 'GetTransactionStatus', data)
+        else:
+            resp, cont = self.do_request('GetTransactionStatus', data)
         return self._parse_response(cont)
 
     def pay(self, sender_token_id=None, transaction_amount=None, currency='USD', \
@@ -206,15 +226,19 @@ class FlexiblePaymentsService(object):
         :keyword transaction_amount: Amount to charge
         :keyword caller_reference: Value to identify request
         :keyword sender_description: Description or note for transaction
-        :keyword params: Optional parameters to send as dict
+        :keyword params: Optional parameters to send as dict (the amount must be set
+            with transaction_amount and currency)
 
         """
         if not sender_token_id or not transaction_amount:
             raise AmazonError('You must specify a sender_token_id and transaction_amount')
+        if isinstance(params, dict) and ('TransactionAmount.Value' in params or \
+            'TransactionAmount.CurrencyCode' in params):
+            raise AmazonError('Use transaction_amount and currency to set the amount, not params')
         data = {}
         data['SenderTokenId'] = sender_token_id
         data['TransactionAmount.CurrencyCode'] = currency
-        data['TransactionAmount.Value'] = transaction_amount
+        data['TransactionAmount.Value'] = self._format_amount(transaction_amount, currency)
         if not caller_reference:
             caller_reference = str(uuid.uuid4())
         data['CallerReference'] = caller_reference
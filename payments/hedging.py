@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#   Copyright 2011 Evan Hazlett
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import fractions
+import threading
+import time
+import Queue
+
+class Hedger(object):
+    """
+    Hedges slow requests by sending a second attempt and using whichever
+    attempt answers first.  Only use with idempotent (read-only) requests.
+
+    """
+    def __init__(self, percentile=95, initial_delay=1.0, min_delay=0.05, max_hedge_ratio=0.1, \
+        max_hedge_burst=2, window=100):
+        """
+
+        :keyword percentile: Latency percentile to wait for before hedging (default 95)
+        :keyword initial_delay: Seconds to wait before hedging until latencies are known
+        :keyword min_delay: Minimum seconds to wait before hedging
+        :keyword max_hedge_ratio: Maximum ratio of hedged requests to requests (default 0.1)
+        :keyword max_hedge_burst: Maximum number of hedges allowed in a row, no matter
+            how many requests came before (default 2)
+        :keyword window: Number of recent latencies used for the percentile
+
+        """
+        self.__percentile = percentile
+        self.__initial_delay = initial_delay
+        self.__min_delay = min_delay
+        # exact so ten requests at 0.1 add up to one token
+        self.__max_hedge_ratio = fractions.Fraction(str(max_hedge_ratio))
+        self.__max_hedge_burst = max_hedge_burst
+        # token bucket -- each request adds max_hedge_ratio and each hedge uses one
+        self.__hedge_tokens = 0
+        self.__latencies = collections.deque(maxlen=window)
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        self.__hedges = 0
+        self.__hedges_won = 0
+
+    def get_delay(self):
+        """
+        Returns the number of seconds to wait before hedging a request
+
+        """
+        with self.__lock:
+            latencies = sorted(self.__latencies)
+        if not latencies:
+            return self.__initial_delay
+        i = min(int(len(latencies) * self.__percentile / 100.0), len(latencies) - 1)
+        return max(latencies[i], self.__min_delay)
+
+    def get_metrics(self):
+        """
+        Returns hedging metrics
+
+        :rtype: requests, hedges and hedges_won as dict
+
+        """
+        with self.__lock:
+            return {
+                'requests': self.__requests,
+                'hedges': self.__hedges,
+                'hedges_won': self.__hedges_won,
+            }
+
+    def _attempt(self, attempt, results, func, args, kwargs):
+        start = time.time()
+        try:
+            result = (attempt, True, func(*args, **kwargs))
+        except Exception as e:
+            result = (attempt, False, e)
+        else:
+            with self.__lock:
+                self.__latencies.append(time.time() - start)
+        results.put(result)
+
+    def _start_attempt(self, attempt, results, func, args, kwargs):
+        t = threading.Thread(target=self._attempt, args=(attempt, results, func, args, kwargs))
+        t.daemon = True
+        t.start()
+
+    def call(self, func=None, *args, **kwargs):
+        """
+        Calls func, hedging it with a second call if it is slower than the
+        current delay and the hedge budget allows
+
+        :keyword func: Function to call
+        :rtype: result of the first successful call
+
+        """
+        results = Queue.Queue()
+        with self.__lock:
+            self.__requests += 1
+            self.__hedge_tokens = min(self.__hedge_tokens + self.__max_hedge_ratio, \
+                self.__max_hedge_burst)
+        self._start_attempt(0, results, func, args, kwargs)
+        attempts = 1
+        try:
+            attempt, ok, value = results.get(timeout=self.get_delay())
+        except Queue.Empty:
+            with self.__lock:
+                hedge = self.__hedge_tokens >= 1
+                if hedge:
+                    self.__hedge_tokens -= 1
+                    self.__hedges += 1
+            if hedge:
+                self._start_attempt(1, results, func, args, kwargs)
+                attempts = 2
+            attempt, ok, value = results.get()
+        if not ok and attempts == 2:
+            # the other attempt may still succeed
+            other = results.get()
+            if other[1]:
+                attempt, ok, value = other
+        if not ok:
+            raise value
+        if attempt == 1:
+            with self.__lock:
+                self.__hedges_won += 1
+        return value
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#   Copyright 2011 Evan Hazlett
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from decimal import Decimal, InvalidOperation
+
+# number of decimal places allowed for each supported currency
+CURRENCY_SCALES = {
+    'AUD': 2, 'BRL': 2, 'CAD': 2, 'CHF': 2, 'CZK': 2, 'DKK': 2, 'EUR': 2, 'GBP': 2,
+    'HKD': 2, 'HUF': 0, 'ILS': 2, 'JPY': 0, 'MXN': 2, 'MYR': 2, 'NOK': 2, 'NZD': 2,
+    'PHP': 2, 'PLN': 2, 'SEK': 2, 'SGD': 2, 'THB': 2, 'TWD': 0, 'USD': 2,
+}
+
+class MoneyError(Exception):
+    def __init__(self, value):
+        # set args so the error can be pickled (i.e. by PaymentWorkerPool)
+        Exception.__init__(self, value)
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+class Money(object):
+    """
+    Decimal backed amount of money in a single currency
+
+    """
+    def __init__(self, amount=None, currency='USD'):
+        """
+        Amounts are validated against the scale of the currency -- i.e.
+        Money('10.5') is 10.50 USD but Money('10.555') raises a MoneyError.
+
+        :keyword amount: Amount as Decimal, string, int, float or Money
+        :keyword currency: Currency code (default USD)
+
+        """
+        if currency not in CURRENCY_SCALES:
+            raise MoneyError('Unsupported currency: {0}'.format(currency))
+        if isinstance(amount, bool):
+            raise MoneyError('Invalid amount: {0}'.format(amount))
+        if isinstance(amount, Money):
+            if amount.currency != currency:
+                raise MoneyError('Cannot convert {0} to {1}'.format(amount.currency, currency))
+            amount = amount.amount
+        elif isinstance(amount, float):
+            # use the shortest repr so 0.1 is 0.1 and not 0.1000000000000000055511...
+            amount = repr(amount)
+        try:
+            value = Decimal(amount)
+            if not value.is_finite():
+                raise InvalidOperation
+            quantized = value.quantize(Decimal(1).scaleb(-CURRENCY_SCALES[currency]))
+        except (InvalidOperation, TypeError, ValueError):
+            raise MoneyError('Invalid amount: {0}'.format(amount))
+        if quantized != value:
+            raise MoneyError('Amount {0} has too many decimal places for {1}'.format(amount, \
+                currency))
+        if quantized < 0:
+            raise MoneyError('Amount must not be negative: {0}'.format(amount))
+        if quantized == 0:
+            # -0 would be sent as -0.00
+            quantized = abs(quantized)
+        self.amount = quantized
+        self.currency = currency
+
+    def __str__(self):
+        return str(self.amount)
+
+    def __repr__(self):
+        return 'Money({0!r}, {1!r})'.format(str(self.amount), self.currency)
+
+    def __eq__(self, other):
+        return isinstance(other, Money) and self.currency == other.currency and \
+            self.amount == other.amount
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.amount, self.currency))
+
+    def __add__(self, other):
+        if not isinstance(other, Money) or other.currency != self.currency:
+            raise MoneyError('Cannot add {0!r} to {1!r}'.format(other, self))
+        return Money(self.amount + other.amount, self.currency)
+
+def _get_limits(limits=None):
+    """
+    Returns limits as dict of currency to Money
+
+    """
+    if limits is None:
+        return {}
+    if isinstance(limits, Money):
+        return {limits.currency: limits}
+    if not isinstance(limits, dict):
+        raise MoneyError('Limits must be Money or a dict of currency to amount: {0}'.format( \
+            limits))
+    return dict((currency, Money(amount, currency)) for currency, amount in limits.iteritems())
+
+def validate_batch(payments=None, max_amount_per_payment=None, max_total_amount=None):
+    """
+    Validates a batch of payments before any of them are sent.  All payments
+    are checked in a single pass and every problem is reported in one error.
+
+    :keyword payments: list of payments as dicts -- format must be the following:
+        {'currency': 'USD', 'amount': '10.00'} or
+        {'currency': 'USD', 'receivers': {'receiver@domain.com': '10.00'}}
+        If both amount and receivers are given the receivers must add up to amount.
+    :keyword max_amount_per_payment: Max amount for each payment as Money or as dict of
+        currency to amount -- i.e. {'USD': 1000, 'JPY': 100000}
+    :keyword max_total_amount: Max total amount of the batch as Money or as dict of
+        currency to amount
+    :rtype: total amount for each currency as dict of Money
+
+    Limits only apply to payments in the same currency.  Invalid limits raise a
+    MoneyError before any payment is checked.
+
+    """
+    max_amounts = _get_limits(max_amount_per_payment)
+    max_totals = _get_limits(max_total_amount)
+    errors = []
+    totals = {}
+    for i, payment in enumerate(payments or []):
+        if not isinstance(payment, dict):
+            errors.append('Payment {0}: must be a dict, not {1}'.format(i, \
+                payment.__class__.__name__))
+            continue
+        currency = payment.get('currency', 'USD')
+        if currency not in CURRENCY_SCALES:
+            errors.append('Payment {0}: unsupported currency {1}'.format(i, currency))
+            continue
+        try:
+            amount = None
+            if 'amount' in payment:
+                amount = Money(payment['amount'], currency)
+            receivers = payment.get('receivers')
+            if receivers is not None and not isinstance(receivers, dict):
+                raise MoneyError('receivers must be a dict, not {0}'.format( \
+                    receivers.__class__.__name__))
+            if receivers:
+                receivers_total = Money(0, currency)
+                for k,v in receivers.iteritems():
+                    receivers_total += Money(v, currency)
+                if amount is None:
+                    amount = receivers_total
+                elif amount != receivers_total:
+                    raise MoneyError('receivers total {0} does not match amount {1}'.format( \
+                        receivers_total, amount))
+            if amount is None:
+                raise MoneyError('no amount or receivers')
+            if amount.amount == 0:
+                raise MoneyError('amount must be greater than zero')
+            if currency in max_amounts and amount.amount > max_amounts[currency].amount:
+                raise MoneyError('amount {0} is over the max of {1}'.format(amount, \
+                    max_amounts[currency]))
+        except MoneyError as e:
+            errors.append('Payment {0}: {1}'.format(i, e.value))
+            continue
+        if currency in totals:
+            totals[currency] += amount
+        else:
+            totals[currency] = amount
+    for currency in sorted(totals.keys()):
+        if currency in max_totals and totals[currency].amount > max_totals[currency].amount:
+            errors.append('Total {0} {1} is over the max of {2}'.format(totals[currency], \
+                currency, max_totals[currency]))
+    if errors:
+        raise MoneyError('Invalid batch: {0}'.format('. '.join(errors)))
+    return totals
@@ -15,22 +15,71 @@
 
 import httplib2
 import urllib
+import io
 import logging
 from datetime import datetime, timedelta
+from payments.money import Money, MoneyError
 
 class PayPalError(Exception):
     def __init__(self, value):
+        # set args so the error can be pickled (i.e. by PaymentWorkerPool)
+        Exception.__init__(self, value)
         self.value = value
     def __str__(self):
         return repr(self.value)
 
+class RequestBuilder(object):
+    """
+    Builds urlencoded request bodies from a precomputed static segment
+
+    """
+    def __init__(self, static_data=None):
+        """
+        Encodes the static fields once so they can be reused for every request
+
+        :keyword static_data: Fields sent with every request as dict
+
+        """
+        static_data = static_data or {}
+        self.__static_keys = frozenset(static_data.keys())
+        self.__static_body = urllib.urlencode(static_data)
+
+    def build(self, data=None, extra=None):
+        """
+        Returns the urlencoded body for the static segment followed by the specified
+        fields.  Fields in data that are also static or in extra are skipped and
+        neither dict is modified.
+
+        :keyword data: Variable fields to send as dict
+        :keyword extra: Per-call fields that take precedence over data as dict
+            (i.e. the Express Checkout METHOD)
+        :rtype: urlencoded body as string
+
+        """
+        buf = io.BytesIO()
+        buf.write(self.__static_body)
+        extra = extra or {}
+        for fields in (extra, data):
+            if not fields:
+                continue
+            for k,v in fields.iteritems():
+                if k in self.__static_keys or (fields is data and k in extra):
+                    continue
+                if buf.tell():
+                    buf.write('&')
+                buf.write(urllib.quote_plus(str(k)))
+                buf.write('=')
+                buf.write(urllib.quote_plus(str(v)))
+        return buf.getvalue()
+
 class AdaptivePaymentsAPI(object):
     """
     PayPal Adaptive Payments API operations
 
     """
     def __init__(self, api_username=None, api_password=None, api_signature=None, app_id='default', \
-        cancel_url=None, return_url=None, ipn_url=None, api_error_lang='en_US', debug=False):
+        cancel_url=None, return_url=None, ipn_url=None, api_error_lang='en_US', debug=False, \
+        hedger=None):
         """
         AdaptivePayments API 
 
@@ -43,6 +92,8 @@ class AdaptivePaymentsAPI(object):
         :keyword ipn_url: Url used for Instant Payment notification
         :keyword api_error_lang: Language used for error responses (default en_US)
         :keyword debug: Sets the url to the PayPal sandbox url (default False)
+        :keyword hedger: Optional Hedger used for read-only lookups (payment and
+            preapproval details)
 
         """
         if not api_username or not api_password or not api_signature or not cancel_url \
@@ -52,6 +103,7 @@ class AdaptivePaymentsAPI(object):
         self.__api_username = api_username
         self.__api_password = api_password
         self.__api_signature = api_signature
+        self.__hedger = hedger
         self.__api_request_format = 'NV'
         self.__api_response_format = 'NV'
         self.__api_app_id = app_id
@@ -63,8 +115,22 @@ class AdaptivePaymentsAPI(object):
             self.__api_base_url = 'https://svcs.sandbox.paypal.com/AdaptivePayments'
         else:
             self.__api_base_url = 'https://svcs.paypal.com/AdaptivePayments'
+        self.__api_headers = {
+            'X-PAYPAL-SECURITY-USERID': self.__api_username,
+            'X-PAYPAL-SECURITY-PASSWORD': self.__api_password,
+            'X-PAYPAL-SECURITY-SIGNATURE': self.__api_signature,
+            'X-PAYPAL-REQUEST-DATA-FORMAT': self.__api_request_format,
+            'X-PAYPAL-RESPONSE-DATA-FORMAT': self.__api_response_format,
+            'X-PAYPAL-APPLICATION-ID': self.__api_app_id,
+        }
+        self.__request_builder = RequestBuilder({
+            'cancelUrl': self.__api_cancel_url,
+            'returnUrl': self.__api_return_url,
+            'ipnNotificationUrl': self.__api_ipn_url,
+            'requestEnvelope.errorLanguage': self.__api_error_lang,
+        })
     
-    def do_request(self, action=None, data={}):
+    def do_request(self, action=None, data=None):
         """
         Makes a PayPal AdaptivePayments API request with the specified params
         
@@ -77,27 +143,34 @@ class AdaptivePaymentsAPI(object):
             raise PayPalError('You must specify an action')
         url = '{0}/{1}'.format(self.__api_base_url, action)
         http = httplib2.Http()
-        headers = {
-            'X-PAYPAL-SECURITY-USERID': self.__api_username,
-            'X-PAYPAL-SECURITY-PASSWORD': self.__api_password,
-            'X-PAYPAL-SECURITY-SIGNATURE': self.__api_signature,
-            'X-PAYPAL-REQUEST-DATA-FORMAT': self.__api_request_format,
-            'X-PAYPAL-RESPONSE-DATA-FORMAT': self.__api_response_format,
-            'X-PAYPAL-APPLICATION-ID': self.__api_app_id,
-        }
         method = 'POST'
-        data['cancelUrl'] = self.__api_cancel_url
-        data['returnUrl'] = self.__api_return_url
-        data['ipnNotificationUrl'] = self.__api_ipn_url
-        data['requestEnvelope.errorLanguage'] = self.__api_error_lang
-        params = urllib.urlencode(data)
-        resp, content = http.request(url, method, params, headers=headers)
+        params = self.__request_builder.build(data)
+        resp, content = http.request(url, method, params, headers=self.__api_headers)
         data = {}
         if content.find('&') > -1:
             for x in content.split('&'):
                 k,v = x.split('=')
                 data[k] = v
         return (resp, data)
+
+    def _format_amount(self, amount=None, currency='USD'):
+        """
+        Validates an amount and formats it for the request
+
+        """
+        try:
+            return str(Money(amount, currency))
+        except MoneyError as e:
+            raise PayPalError(e.value)
+
+    def _do_read_request(self, action=None, data=None):
+        """
+        Makes a read-only request, hedged if a hedger was specified
+
+        """
+        if self.__hedger:
+            return self.__hedger.call(self.do_request, action=action, data=data)
+        return self.do_request(action=action, data=data)
     
     def get_payment_details(self, pay_key=None):
         """
@@ -112,7 +185,7 @@ class AdaptivePaymentsAPI(object):
         data = {
             'payKey': pay_key,
         }
-        resp, cont = self.do_request(action='PaymentDetails', data=data)
+        resp, cont = self._do_read_request(action='PaymentDetails', data=data)
         if 'responseEnvelope.ack' not in cont:
             raise PayPalError('Error: Invalid PayPal response: {0}'.format(cont))
         if cont['responseEnvelope.ack'].lower() != 'success':
@@ -137,7 +210,7 @@ class AdaptivePaymentsAPI(object):
         data = {
             'preapprovalKey': preapproval_key,
         }
-        resp, cont = self.do_request(action='PreapprovalDetails', data=data)
+        resp, cont = self._do_read_request(action='PreapprovalDetails', data=data)
         if 'responseEnvelope.ack' not in cont:
             raise PayPalError('Error: Invalid PayPal response: {0}'.format(cont))
         if cont['responseEnvelope.ack'].lower() != 'success':
@@ -174,7 +247,8 @@ class AdaptivePaymentsAPI(object):
         i = 0
         for k,v in receivers.iteritems():
             data['receiverList.receiver({0}).email'.format(i)] = k
-            data['receiverList.receiver({0}).amount'.format(i)] = v
+            data['receiverList.receiver({0}).amount'.format(i)] = self._format_amount(v, currency)
+            i += 1
         resp, cont = self.do_request(action='Pay', data=data)
         if 'responseEnvelope.ack' not in cont:
             raise PayPalError('Error: Invalid PayPal response: {0}'.format(cont))
@@ -216,12 +290,13 @@ class AdaptivePaymentsAPI(object):
         i = 0
         for k,v in receivers.iteritems():
             data['receiverList.receiver({0}).email'.format(i)] = k
-            data['receiverList.receiver({0}).amount'.format(i)] = v
+            data['receiverList.receiver({0}).amount'.format(i)] = self._format_amount(v, currency)
             if len(receivers) > 1:
                 if i == 0:
                     data['receiverList.receiver(0).primary'] = 'true'
                 else:
                     data['receiverList.receiver({0}).primary'.format(i)] = 'false'
+            i += 1
         resp, cont = self.do_request(action='Pay', data=data)
         if 'responseEnvelope.ack' not in cont:
             raise PayPalError('Error: Invalid PayPal response: {0}'.format(cont))
@@ -262,11 +337,9 @@ class AdaptivePaymentsAPI(object):
             'endingDate': ending_date,
             'pinType': pin_type,
             'senderEmail': sender_email,
-            'maxAmountPerPayment': max_amount_per_payment,
+            'maxAmountPerPayment': self._format_amount(max_amount_per_payment, currency),
             'maxNumberOfPayments': max_number_of_payments,
-            'maxTotalAmountOfAllPayments': max_total_amount_of_payments,
-            'cancelUrl': self.__api_cancel_url,
-            'returnUrl': self.__api_return_url,
+            'maxTotalAmountOfAllPayments': self._format_amount(max_total_amount_of_payments, currency),
         }
         resp, cont = self.do_request(action='Preapproval', data=data)
         if 'responseEnvelope.ack' not in cont:
@@ -315,8 +388,18 @@ class ExpressCheckoutAPI(object):
             self.__api_base_url = 'https://api-3t.sandbox.paypal.com/nvp'
         else:
             self.__api_base_url = 'https://api-3t.paypal.com/nvp'
+        self.__api_headers = {
+        }
+        self.__request_builder = RequestBuilder({
+            'VERSION': self.__api_version,
+            'USER': self.__api_username,
+            'PWD': self.__api_password,
+            'SIGNATURE': self.__api_signature,
+            'RETURNURL': self.__api_return_url,
+            'CANCELURL': self.__api_cancel_url,
+        })
     
-    def do_request(self, method=None, data={}):
+    def do_request(self, method=None, data=None):
         """
         Makes a PayPal Express Checkout API request with the specified params
         
@@ -329,18 +412,9 @@ class ExpressCheckoutAPI(object):
             raise PayPalError('You must specify a method and data')
         url = '{0}'.format(self.__api_base_url)
         http = httplib2.Http()
-        headers = {
-        }
         req_method = 'POST'
-        data['METHOD'] = method
-        data['VERSION'] = self.__api_version
-        data['USER'] = self.__api_username
-        data['PWD'] = self.__api_password
-        data['SIGNATURE'] = self.__api_signature
-        data['RETURNURL'] = self.__api_return_url
-        data['CANCELURL'] = self.__api_cancel_url
-        params = urllib.urlencode(data)
-        resp, content = http.request(url, req_method, params, headers=headers)
+        params = self.__request_builder.build(data, {'METHOD': method})
+        resp, content = http.request(url, req_method, params, headers=self.__api_headers)
         data = {}
         if content.find('&') > -1:
             for x in content.split('&'):
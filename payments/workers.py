@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#   Copyright 2011 Evan Hazlett
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import multiprocessing
+import cPickle
+import zlib
+import Queue
+
+class PaymentWorkerError(Exception):
+    def __init__(self, value, error_class=None):
+        # set args so the error can be pickled back from a worker process
+        Exception.__init__(self, value)
+        self.value = value
+        self.error_class = error_class
+    def __str__(self):
+        return repr(self.value)
+
+def _dumps_result(result):
+    """
+    Pickles the result to send back from the worker process.  Results that
+    cannot be pickled are replaced with a PaymentWorkerError.
+
+    """
+    try:
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        if isinstance(result, Exception):
+            # exceptions with their own __init__ often pickle but do not unpickle
+            cPickle.loads(data)
+        return data
+    except Exception:
+        pass
+    if isinstance(result, Exception):
+        # errors in this package keep their message in value
+        error = PaymentWorkerError('{0}: {1}'.format(result.__class__.__name__, \
+            getattr(result, 'value', result)), result.__class__)
+        try:
+            return cPickle.dumps(error, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            error = PaymentWorkerError(error.value)
+    else:
+        error = PaymentWorkerError('Unable to pickle result of type {0}'.format( \
+            result.__class__.__name__))
+    return cPickle.dumps(error, cPickle.HIGHEST_PROTOCOL)
+
+def _loads_result(data):
+    try:
+        return cPickle.loads(data)
+    except Exception as e:
+        return PaymentWorkerError('Unable to unpickle result: {0}'.format(e))
+
+def _run_worker(api_class, api_kwargs, jobs, results):
+    """
+    Worker process loop -- creates its own API client and runs jobs until
+    it receives None.  Results are sent back pickled.
+
+    """
+    api = None
+    api_error = None
+    try:
+        api = api_class(**api_kwargs)
+    except Exception as e:
+        api_error = _dumps_result(e)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, method, args, kwargs = job
+        if api_error is not None:
+            data = api_error
+        else:
+            try:
+                result = getattr(api, method)(*args, **kwargs)
+            except Exception as e:
+                result = e
+            data = _dumps_result(result)
+        results.put((job_id, data))
+
+class PaymentWorkerPool(object):
+    """
+    Runs payment API calls across multiple processes
+
+    """
+    def __init__(self, api_class=None, api_kwargs=None, processes=None, poll_interval=0.5):
+        """
+        Each worker process creates its own api_class instance.  Jobs are sharded
+        by key so jobs with the same key (i.e. account or caller reference) always
+        run in order on the same worker.  A worker process that exits is replaced
+        and the jobs it had not answered are failed.
+
+        :keyword api_class: API class to use (i.e. AdaptivePaymentsAPI)
+        :keyword api_kwargs: Keyword arguments used to create the api_class instance
+        :keyword processes: Number of worker processes (default number of cpus)
+        :keyword poll_interval: Seconds between checks for dead worker processes
+
+        """
+        if not api_class:
+            raise PaymentWorkerError('You must specify an api_class')
+        if not processes:
+            processes = multiprocessing.cpu_count()
+        self.__api_class = api_class
+        self.__api_kwargs = api_kwargs or {}
+        self.__processes = processes
+        self.__poll_interval = poll_interval
+        self.__results = multiprocessing.Queue()
+        self.__queues = [None] * processes
+        self.__workers = [None] * processes
+        for shard in range(processes):
+            self._start_worker(shard)
+        self.__next_job_id = 0
+        # shard of each job that has not been answered yet
+        self.__pending = {}
+        self.__finished = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_shard(self, key=None):
+        return zlib.crc32(str(key)) % self.__processes
+
+    def _start_worker(self, shard=None):
+        """
+        Starts a worker process with a new job queue for the shard
+
+        """
+        jobs = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=_run_worker, \
+            args=(self.__api_class, self.__api_kwargs, jobs, self.__results))
+        worker.daemon = True
+        worker.start()
+        self.__queues[shard] = jobs
+        self.__workers[shard] = worker
+
+    def _finish(self, job_id, data):
+        self.__finished[job_id] = _loads_result(data)
+        self.__pending.pop(job_id, None)
+
+    def _check_workers(self, restart=True):
+        """
+        Fails the pending jobs of worker processes that have exited and starts
+        new workers in their place
+
+        """
+        dead = set(i for i, worker in enumerate(self.__workers) if not worker.is_alive())
+        if not dead:
+            return
+        # read everything the dead workers sent before they exited
+        while True:
+            try:
+                job_id, data = self.__results.get(False)
+            except Queue.Empty:
+                break
+            self._finish(job_id, data)
+        for job_id, shard in self.__pending.items():
+            if shard in dead:
+                self.__finished[job_id] = PaymentWorkerError( \
+                    'Worker process {0} exited'.format(shard))
+                del self.__pending[job_id]
+        if restart:
+            for shard in dead:
+                self._start_worker(shard)
+
+    def _collect(self, restart=True):
+        """
+        Waits for all pending jobs
+
+        """
+        while self.__pending:
+            try:
+                job_id, data = self.__results.get(timeout=self.__poll_interval)
+            except Queue.Empty:
+                self._check_workers(restart)
+                continue
+            self._finish(job_id, data)
+
+    def submit(self, *args, **kwargs):
+        """
+        Queues an API call on the worker that owns the key -- i.e.
+        submit(key, method, *args, **kwargs).  key and method are positional
+        only so every keyword argument is passed to the API method.
+
+        :param key: Value used to shard the job (i.e. account or caller reference)
+        :param method: Name of the API method to call (i.e. pay, request_payment)
+        :rtype: job id as int
+
+        """
+        if len(args) < 2 or args[0] is None or not args[1]:
+            raise PaymentWorkerError('You must specify a key and method')
+        key, method, args = args[0], args[1], args[2:]
+        if self.__workers is None:
+            raise PaymentWorkerError('Worker pool is closed')
+        shard = self._get_shard(key)
+        if not self.__workers[shard].is_alive():
+            self._check_workers()
+        job_id = self.__next_job_id
+        self.__next_job_id += 1
+        self.__queues[shard].put((job_id, method, args, kwargs))
+        self.__pending[job_id] = shard
+        return job_id
+
+    def get_results(self):
+        """
+        Waits for all submitted jobs to finish.  Failed jobs are returned as the
+        exception they raised instead of being raised.  Exceptions that cannot be
+        sent back from the worker are returned as a PaymentWorkerError with the
+        original class in error_class.
+
+        :rtype: results as dict keyed by job id
+
+        """
+        if self.__workers is not None:
+            self._collect()
+        results = self.__finished
+        self.__finished = {}
+        return results
+
+    def close(self):
+        """
+        Stops the worker processes once their queued jobs are done.  Results
+        of those jobs are still available from get_results.
+
+        """
+        if self.__workers is None:
+            return
+        for jobs in self.__queues:
+            jobs.put(None)
+        self._collect(restart=False)
+        for worker in self.__workers:
+            worker.join()
+        self.__queues = None
+        self.__workers = None
@@ -6,10 +6,17 @@ sys.path.insert(0, '../')
 import unittest
 import urllib2
 import cookielib
-from payments.paypal import AdaptivePaymentsAPI, ExpressCheckoutAPI
-from payments.amazon import FlexiblePaymentsService, FPSResponseParser
+from payments.paypal import AdaptivePaymentsAPI, ExpressCheckoutAPI, RequestBuilder, PayPalError
+from payments.amazon import FlexiblePaymentsService, FPSResponseParser, AmazonError
+from payments.workers import PaymentWorkerPool, PaymentWorkerError
+from payments.hedging import Hedger
+from payments.money import Money, MoneyError, validate_batch
 from datetime import datetime, timedelta
 import uuid
+import time
+import os
+import threading
+import pickle
 try:
     import local_settings
 except ImportError:
@@ -63,6 +70,69 @@ class TestAdaptivePaymentsAPI(unittest.TestCase):
         self.assertEqual(resp['responseEnvelope.ack'].lower(), 'success')
         self.assertTrue(resp.has_key('preapprovalKey'))
 
+class TestRequestBuilder(unittest.TestCase):
+    def setUp(self):
+        self.builder = RequestBuilder({'returnUrl': 'http://site.com'})
+
+    def test_build(self):
+        params = self.builder.build({'payKey': 'AP-1234', 'memo': 'Test Payment'})
+        self.assertTrue(params.startswith('returnUrl=http%3A%2F%2Fsite.com&'))
+        self.assertTrue(params.find('payKey=AP-1234') > -1)
+        self.assertTrue(params.find('memo=Test+Payment') > -1)
+
+    def test_build_does_not_modify_data(self):
+        data = {'payKey': 'AP-1234', 'returnUrl': 'http://other.com'}
+        params = self.builder.build(data)
+        self.assertEqual(data, {'payKey': 'AP-1234', 'returnUrl': 'http://other.com'})
+        self.assertEqual(params.count('returnUrl='), 1)
+
+    def test_build_extra(self):
+        data = {'payKey': 'AP-1234', 'METHOD': 'Other'}
+        params = self.builder.build(data, {'METHOD': 'SetExpressCheckout'})
+        self.assertEqual(params.count('METHOD='), 1)
+        self.assertTrue(params.find('METHOD=SetExpressCheckout') > -1)
+        self.assertTrue(params.find('payKey=AP-1234') > -1)
+        self.assertEqual(data, {'payKey': 'AP-1234', 'METHOD': 'Other'})
+
+    def test_build_no_data(self):
+        self.assertEqual(self.builder.build(), 'returnUrl=http%3A%2F%2Fsite.com')
+        self.assertEqual(RequestBuilder().build({'a': 1}), 'a=1')
+
+class TestAdaptivePaymentsReceivers(unittest.TestCase):
+    def setUp(self):
+        self.api = AdaptivePaymentsAPI('username', 'password', 'signature', 'app', \
+            'http://site.com', 'http://site.com', 'http://site.com', debug=True)
+        self.api.do_request = self.do_request
+        self.receivers = {
+            'a@domain.com': '10.00',
+            'b@domain.com': '20.00',
+            'c@domain.com': '30.00',
+        }
+
+    def do_request(self, action=None, data=None):
+        self.data = data
+        return ({}, {'responseEnvelope.ack': 'Success'})
+
+    def get_receivers(self):
+        receivers = {}
+        for i in range(len(self.receivers)):
+            email = self.data['receiverList.receiver({0}).email'.format(i)]
+            receivers[email] = self.data['receiverList.receiver({0}).amount'.format(i)]
+        self.assertFalse('receiverList.receiver({0}).email'.format(i + 1) in self.data)
+        return receivers
+
+    def test_request_payment(self):
+        self.api.request_payment(sender_email='sender@domain.com', receivers=self.receivers)
+        self.assertEqual(self.get_receivers(), self.receivers)
+
+    def test_do_preapproval_payment(self):
+        self.api.do_preapproval_payment(sender_email='sender@domain.com', preapproval_key='PA-1', \
+            receivers=self.receivers)
+        self.assertEqual(self.get_receivers(), self.receivers)
+        self.assertEqual(self.data['receiverList.receiver(0).primary'], 'true')
+        for i in range(1, len(self.receivers)):
+            self.assertEqual(self.data['receiverList.receiver({0}).primary'.format(i)], 'false')
+
 class TestExpressCheckoutAPI(unittest.TestCase):
     def setUp(self):
         self.api_username = getattr(local_settings, 'PAYPAL_API_USERNAME', None)
@@ -88,6 +158,288 @@ class TestExpressCheckoutAPI(unittest.TestCase):
         self.assertEqual(cont['ACK'].lower(), 'success')
         self.assertTrue(cont.has_key('TOKEN'))
 
+class UnpicklableError(Exception):
+    def __init__(self, value, code):
+        self.value = value
+        self.code = code
+
+class EchoAPI(object):
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.calls = []
+
+    def pay(self, reference=None):
+        self.calls.append(reference)
+        return (self.prefix, reference, list(self.calls))
+
+    def echo(self, *args, **kwargs):
+        return (args, kwargs)
+
+    def fail(self):
+        raise PayPalError('declined')
+
+    def fail_unpicklable(self):
+        raise UnpicklableError('declined', 10)
+
+    def get_lock(self):
+        return threading.Lock()
+
+    def exit(self):
+        os._exit(1)
+
+class BrokenAPI(object):
+    def __init__(self):
+        raise PayPalError('You must specify an api_username')
+
+class TestPaymentWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = PaymentWorkerPool(EchoAPI, {'prefix': 'worker'}, processes=2, \
+            poll_interval=0.05)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_submit(self):
+        job_ids = [self.pool.submit('account-1', 'pay', i) for i in range(5)]
+        results = self.pool.get_results()
+        self.assertEqual(sorted(results.keys()), job_ids)
+        self.assertEqual(results[job_ids[0]][0], 'worker')
+        # jobs with the same key run in order on the same worker
+        self.assertEqual(results[job_ids[-1]][2][-5:], range(5))
+
+    def test_submit_keywords(self):
+        job_id = self.pool.submit('account-1', 'echo', 1, key='k', method='SetExpressCheckout')
+        self.assertEqual(self.pool.get_results()[job_id], ((1,), \
+            {'key': 'k', 'method': 'SetExpressCheckout'}))
+
+    def test_submit_error(self):
+        job_id = self.pool.submit('account-1', 'fail')
+        results = self.pool.get_results()
+        self.assertTrue(isinstance(results[job_id], PayPalError))
+        self.assertEqual(results[job_id].value, 'declined')
+
+    def test_submit_unpicklable_error(self):
+        job_id = self.pool.submit('account-1', 'fail_unpicklable')
+        results = self.pool.get_results()
+        self.assertTrue(isinstance(results[job_id], PaymentWorkerError))
+        self.assertEqual(results[job_id].error_class, UnpicklableError)
+        self.assertTrue(str(results[job_id]).find('declined') > -1)
+
+    def test_submit_unpicklable_result(self):
+        job_id = self.pool.submit('account-1', 'get_lock')
+        results = self.pool.get_results()
+        self.assertTrue(isinstance(results[job_id], PaymentWorkerError))
+
+    def test_worker_exit(self):
+        exit_id = self.pool.submit('account-1', 'exit')
+        job_id = self.pool.submit('account-1', 'pay', 'ref')
+        results = self.pool.get_results()
+        self.assertTrue(isinstance(results[exit_id], PaymentWorkerError))
+        self.assertTrue(isinstance(results[job_id], PaymentWorkerError))
+        # the worker is replaced so the same key works again
+        job_id = self.pool.submit('account-1', 'pay', 'ref')
+        self.assertEqual(self.pool.get_results()[job_id][1], 'ref')
+
+    def test_api_class_error(self):
+        pool = PaymentWorkerPool(BrokenAPI, processes=1, poll_interval=0.05)
+        job_ids = [pool.submit('account-1', 'pay', i) for i in range(2)]
+        pool.close()
+        results = pool.get_results()
+        for job_id in job_ids:
+            self.assertTrue(isinstance(results[job_id], PayPalError))
+
+    def test_close(self):
+        job_id = self.pool.submit('account-1', 'pay', 'ref')
+        self.pool.close()
+        self.assertEqual(self.pool.get_results()[job_id][1], 'ref')
+        self.assertRaises(PaymentWorkerError, self.pool.submit, 'account-1', 'pay')
+
+class TestHedger(unittest.TestCase):
+    def setUp(self):
+        self.hedger = Hedger(initial_delay=0.05, max_hedge_ratio=1.0)
+        self.calls = []
+
+    def lookup(self, delays):
+        delay = delays[len(self.calls)]
+        self.calls.append(delay)
+        time.sleep(delay)
+        return delay
+
+    def test_call(self):
+        self.assertEqual(self.hedger.call(self.lookup, [0]), 0)
+        self.assertEqual(self.hedger.get_metrics(), {'requests': 1, 'hedges': 0, 'hedges_won': 0})
+
+    def test_call_hedged(self):
+        self.assertEqual(self.hedger.call(self.lookup, [1.0, 0]), 0)
+        self.assertEqual(self.hedger.get_metrics(), {'requests': 1, 'hedges': 1, 'hedges_won': 1})
+
+    def test_call_hedge_budget(self):
+        hedger = Hedger(initial_delay=0.05, max_hedge_ratio=0)
+        self.assertEqual(hedger.call(self.lookup, [0.1, 0]), 0.1)
+        self.assertEqual(hedger.get_metrics()['hedges'], 0)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_call_hedge_burst(self):
+        hedger = Hedger(percentile=50, initial_delay=0.05, max_hedge_ratio=0.1, max_hedge_burst=1)
+        for i in range(20):
+            hedger.call(lambda: None)
+        # a stall after many fast requests can only use the burst, not the
+        # budget built up by every earlier request
+        for i in range(4):
+            hedger.call(time.sleep, 0.1)
+        self.assertEqual(hedger.get_metrics()['hedges'], 1)
+
+    def test_call_hedge_ratio(self):
+        hedger = Hedger(percentile=50, initial_delay=0.05, max_hedge_ratio=0.1, max_hedge_burst=1)
+        for i in range(9):
+            hedger.call(lambda: None)
+        # the tenth request earns the first hedge
+        hedger.call(time.sleep, 0.1)
+        self.assertEqual(hedger.get_metrics()['hedges'], 1)
+
+    def test_call_error(self):
+        def fail():
+            raise ValueError('stalled')
+        self.assertRaises(ValueError, self.hedger.call, fail)
+
+class TestMoney(unittest.TestCase):
+    def test_money(self):
+        self.assertEqual(str(Money('10.5')), '10.50')
+        self.assertEqual(str(Money(200)), '200.00')
+        self.assertEqual(str(Money(0.1)), '0.10')
+        self.assertEqual(str(Money('1000', 'JPY')), '1000')
+        self.assertEqual(Money('1.10') + Money(2), Money('3.10'))
+        self.assertEqual(str(Money('-0')), '0.00')
+
+    def test_money_invalid(self):
+        self.assertRaises(MoneyError, Money, '10.555')
+        self.assertRaises(MoneyError, Money, '10.5', 'JPY')
+        self.assertRaises(MoneyError, Money, '-1')
+        self.assertRaises(MoneyError, Money, 'abc')
+        self.assertRaises(MoneyError, Money, None)
+        self.assertRaises(MoneyError, Money, True)
+        self.assertRaises(MoneyError, Money, '10', 'XYZ')
+        self.assertRaises(MoneyError, Money('1', 'USD').__add__, Money('1', 'EUR'))
+
+    def test_validate_batch(self):
+        payments = [
+            {'currency': 'USD', 'amount': '10.00'},
+            {'currency': 'USD', 'receivers': {'a@domain.com': '5.25', 'b@domain.com': 4.75}},
+            {'currency': 'JPY', 'amount': 500},
+        ]
+        totals = validate_batch(payments, max_amount_per_payment={'USD': 1000, 'JPY': 1000})
+        self.assertEqual(totals, {'USD': Money('20'), 'JPY': Money(500, 'JPY')})
+
+    def test_validate_batch_invalid(self):
+        payments = [
+            {'currency': 'USD', 'amount': '10.001'},
+            {'currency': 'USD', 'amount': '10.00', 'receivers': {'a@domain.com': '9.00'}},
+            {'currency': 'XYZ', 'amount': '1'},
+            {'currency': 'USD', 'amount': '2000'},
+            {'currency': 'USD', 'amount': '0'},
+        ]
+        try:
+            validate_batch(payments, max_amount_per_payment=Money(1000))
+            self.fail('MoneyError not raised')
+        except MoneyError as e:
+            for i in range(len(payments)):
+                self.assertTrue(e.value.find('Payment {0}:'.format(i)) > -1)
+        self.assertRaises(MoneyError, validate_batch, [{'amount': '600'}, {'amount': '600'}], \
+            max_total_amount={'USD': 1000})
+
+    def test_validate_batch_malformed(self):
+        payments = [
+            '10.00',
+            {'currency': 'USD', 'receivers': ['a@domain.com', '10.00']},
+            {'currency': 'USD', 'amount': '10.001'},
+        ]
+        try:
+            validate_batch(payments)
+            self.fail('MoneyError not raised')
+        except MoneyError as e:
+            for i in range(len(payments)):
+                self.assertTrue(e.value.find('Payment {0}:'.format(i)) > -1)
+        self.assertEqual(validate_batch(), {})
+
+    def test_money_error_pickle(self):
+        e = pickle.loads(pickle.dumps(MoneyError('Invalid amount'), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(e.value, 'Invalid amount')
+
+    def test_validate_batch_limits(self):
+        payments = [
+            {'currency': 'JPY', 'amount': 900},
+            {'currency': 'USD', 'amount': '900.001'},
+        ]
+        try:
+            validate_batch(payments, max_amount_per_payment={'JPY': 100})
+            self.fail('MoneyError not raised')
+        except MoneyError as e:
+            self.assertTrue(e.value.find('Payment 0: amount 900 is over the max of 100') > -1)
+            self.assertTrue(e.value.find('Payment 1:') > -1)
+        # limits only apply to their own currency
+        totals = validate_batch(payments[:1], max_amount_per_payment=Money(100), \
+            max_total_amount=Money(100))
+        self.assertEqual(totals, {'JPY': Money(900, 'JPY')})
+        # invalid limits are reported once instead of on every payment
+        try:
+            validate_batch(payments, max_amount_per_payment={'JPY': '100.50'})
+            self.fail('MoneyError not raised')
+        except MoneyError as e:
+            self.assertEqual(e.value.find('Payment'), -1)
+        self.assertRaises(MoneyError, validate_batch, payments, max_total_amount=1000)
+
+class RecordingHedger(object):
+    def __init__(self):
+        self.calls = []
+
+    def call(self, func=None, *args, **kwargs):
+        self.calls.append((args, kwargs))
+        return func(*args, **kwargs)
+
+class TestHedgedLookups(unittest.TestCase):
+    def setUp(self):
+        self.hedger = RecordingHedger()
+        self.paypal = AdaptivePaymentsAPI('username', 'password', 'signature', 'app', \
+            'http://site.com', 'http://site.com', 'http://site.com', debug=True, \
+            hedger=self.hedger)
+        self.paypal.do_request = lambda action=None, data=None: \
+            ({}, {'responseEnvelope.ack': 'Success', 'payKey': 'AP-1'})
+        self.fps = FlexiblePaymentsService('key', 'secret', debug=True, hedger=self.hedger)
+        self.fps.do_request = lambda action=None, data=None: \
+            ({}, '<Response><TransactionStatus>Success</TransactionStatus></Response>')
+
+    def test_paypal_lookups(self):
+        self.paypal.get_payment_details('AP-1')
+        self.paypal.get_preapproval_details('PA-1')
+        self.assertEqual([c[1]['action'] for c in self.hedger.calls], \
+            ['PaymentDetails', 'PreapprovalDetails'])
+
+    def test_paypal_payments_not_hedged(self):
+        self.paypal.request_payment(sender_email='sender@domain.com', \
+            receivers={'receiver@domain.com': '10.00'})
+        self.assertEqual(self.hedger.calls, [])
+
+    def test_fps_lookups(self):
+        resp = self.fps.get_transaction_status('T-1')
+        self.assertEqual(resp['TransactionStatus'], 'Success')
+        self.assertEqual([c[0][0] for c in self.hedger.calls], ['GetTransactionStatus'])
+        self.fps.pay('token', '10.00')
+        self.assertEqual(len(self.hedger.calls), 1)
+
+class TestFlexiblePaymentsAmounts(unittest.TestCase):
+    def setUp(self):
+        self.api = FlexiblePaymentsService('key', 'secret', debug=True)
+
+    def test_fps_amounts(self):
+        self.assertRaises(AmazonError, self.api.pay, 'token', '10.00', \
+            params={'TransactionAmount.Value': 10.1})
+        self.assertRaises(AmazonError, self.api.get_authorization_url, 'SingleUse', '10.50', \
+            'Exact', '12345', '1000', '', {'currencyCode': 'JPY'})
+        url = self.api.get_authorization_url('SingleUse', '1050', 'Exact', '12345', '1000', '', \
+            {'currencyCode': 'JPY'})
+        self.assertTrue(url.find('transactionAmount=1050') > -1)
+        self.assertEqual(url.find('transactionAmount=1050.'), -1)
+
 class TestFlexiblePaymentsService(unittest.TestCase):
     def setUp(self):
         self.api_username = getattr(local_settings, 'AWS_ACCESS_KEY_ID', None)